@@ -1,23 +1,33 @@
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
 import datetime
+from functools import lru_cache
+import fnmatch
 from getpass import getpass
 import glob
-import itertools
-import json
+import hashlib
 import os
 from pathlib import Path
-import random
+import re
+import secrets
+import stat
+import subprocess
 from attr import field
 import cattrs
+from cattrs.gen import make_dict_structure_fn, make_dict_unstructure_fn
 import click
+import msgpack
+import orjson
 from invoke import run
 from attrs import define
 import pendulum
 
 
-def _git_root(start=os.getcwd()):
-    p = Path(start)
+@lru_cache(maxsize=None)
+def _git_root(start=None):
+    p = Path(start or os.getcwd())
     while not (p / '.git').is_dir():
-        if p == p.root:
+        if p == p.parent:
             return None
         p = p.parent
     return p
@@ -28,8 +38,9 @@ GITIGNORE_PATH = GIT_ROOT / '.gitignore'
 BLOBMAN_PATH = GIT_ROOT / Path('.blobman/')
 CONFIG_PATH = BLOBMAN_PATH / 'config.json'
 LOCK_PATH = BLOBMAN_PATH / 'lock.json'
-LIST_PATH = BLOBMAN_PATH / 'list.txt'
 PASSWORD_PATH = BLOBMAN_PATH / 'password.txt'
+HASH_CACHE_PATH = BLOBMAN_PATH / 'hash-cache.msgpack'
+HASH_CACHE_GITIGNORE_PATH = BLOBMAN_PATH / '.gitignore'
 
 
 @click.group(help='A simple large binary file manager alongside git, based on Restic backup tool.')
@@ -61,46 +72,51 @@ def init():
     run('restic init', hide=True, env=_get_env(c))
     run(f'git add {LOCK_PATH} {CONFIG_PATH}', hide=True)
 
-    _ensure_line('.blobman/password.txt', GITIGNORE_PATH)
+    _ensure_lines(['.blobman/password.txt'], GITIGNORE_PATH)
     _store_config(c)
 
 
 @cli.command(help='snapshot local blob state remotely')
 @click.option('--dry', 'dry', is_flag=True, default=False, help='show what will be snapshoted')
 def snapshot(dry):
-    c = _load_config()
+    c = _load_config_full()
     _ensure_no_collisions(c)
     diff = _diff_locks(c.lock, c.worktree_lock)
     if dry:
         _print_diff(diff)
         return
-    files = [f['file'] for f in c.worktree_lock.tracked_files]
+    files = c.worktree_lock.files
 
     # save worktree lock upfront
     env = _get_env(c)
-    snaps = json.loads(run('restic snapshots --json', hide=True, env=env).stdout)
+    snaps = orjson.loads(run('restic snapshots --json', hide=True, env=env).stdout)
     tags = set(t for s in snaps for t in s.get('tags', ()) if t.startswith('blobmanid:'))
-    while ('blobmanid:' + (id := hex(random.getrandbits(32))[2:])) in tags:
+    while ('blobmanid:' + (id := secrets.token_hex(4))) in tags:
         pass
     c.lock = c.worktree_lock  # (same object now)
     c.lock.snapshot_tag = id
     _store_config(c)  # TODO: not assume it won't break... store and later do atomic move...
 
-    LIST_PATH.write_text('\n'.join(files + ['.blobman/lock.json']))
-    run(f'restic backup --tag blobmanid:{id} --files-from-verbatim {str(LIST_PATH)}', env=env)
-    os.remove(LIST_PATH)
+    # invoke feeds in_stream byte by byte, so list of files is piped directly
+    subprocess.run(
+        ['restic', 'backup', '--tag', f'blobmanid:{id}', '--files-from-verbatim', '-'],
+        input=''.join(f + '\n' for f in files + ['.blobman/lock.json']),
+        text=True,
+        env=os.environ | env,
+        check=True,
+    )
 
 
 @cli.command(help='sync local state with expected state in lockfile')
 @click.argument('target', required=False)
 @click.option('--dry', 'dry', is_flag=True, default=False)
 def checkout(target, dry):
-    c = _load_config()
+    c = _load_config_full(need_hashes=dry)
     if not target:
         target = c.lock.snapshot_tag
 
     env = _get_env(c)
-    snaps = json.loads(run('restic snapshots --json', env=env, hide=True).stdout)
+    snaps = orjson.loads(run('restic snapshots --json', env=env, hide=True).stdout)
     snapshot_id = next(s['short_id'] for s in snaps if f'blobmanid:{target}' in s['tags'])
 
     target_lock = None
@@ -108,37 +124,41 @@ def checkout(target, dry):
         target_lock = c.lock
     else:
         res = run(f'restic dump {snapshot_id} .blobman/lock.json', env=env, hide=True)
-        target_lock = cattrs.structure(json.loads(res.stdout), LockInfo)
+        target_lock = converter.structure(orjson.loads(res.stdout), LockInfo)
 
-    diff = _diff_locks(c.worktree_lock, target_lock)
     if dry:
-        _print_diff(diff)
+        _print_diff(_diff_locks(c.worktree_lock, target_lock))
         return
     run(f'restic restore {snapshot_id} --target "{c.git_root}"', env=env, hide=True)
 
 
 @cli.command(help='list exact files & snapshot history')
-def status():
-    c = _load_config()
+@click.option('--diff', 'diff', is_flag=True, default=False, help='show changes since last snapshot')
+def status(diff):
+    c = _load_config_full() if diff else _load_config_light()
 
     print('Patterns:\n')
     for id, pat in c.include_patterns.items():
         print(id, '-', pat)
 
     print('\nTracked blobs:\n')
-    for p in _ls(c.include_patterns, root_dir=_git_root()):
+    for p in c.worktree_lock.files if diff else _ls(c.include_patterns, root_dir=GIT_ROOT):
         print(p)
 
+    if diff:
+        _print_diff(_diff_locks(c.lock, c.worktree_lock))
+
     print('\nSnapshots:\n')
-    snapshots = json.loads(run('restic snapshots --json', hide=True, env=_get_env(c)).stdout)
+    snapshots = orjson.loads(run('restic snapshots --json', hide=True, env=_get_env(c)).stdout)
     by_date = lambda s: datetime.datetime.fromisoformat(s['time'])
+    current = c.worktree_lock.snapshot_tag if diff else _locked_snapshot_tag()
     for s in sorted(snapshots, reverse=True, key=by_date):
         id = next(s.removeprefix('blobmanid:') for s in s['tags'] if s.startswith('blobmanid:'))
         now, then = pendulum.now(), pendulum.parse(s['time'])
         print(
             "{} {} | {} ({})".format(
                 id,
-                "*" if id == c.worktree_lock.snapshot_tag else " ",
+                "*" if id == current else " ",
                 (now - then).in_words() + ' ago',
                 then.to_day_datetime_string(),
             )
@@ -148,10 +168,10 @@ def status():
 @cli.command(help='track glob pattern')
 @click.argument('pattern')
 def add(pattern):
-    c = _load_config()
+    c = _load_config_light()
     if pattern in c.include_patterns.values():
         return
-    while (id := hex(random.getrandbits(32))[2:]) in c.include_patterns:
+    while (id := secrets.token_hex(4)) in c.include_patterns:
         pass
     c.include_patterns[id] = pattern
     _ensure_no_collisions(c)
@@ -162,7 +182,7 @@ def add(pattern):
 @cli.command(help='remove tracked pattern by its ID')
 @click.argument('pattern_id')
 def remove(pattern_id: str):
-    c = _load_config()
+    c = _load_config_light()
     del c.include_patterns[pattern_id]
     _store_config(c)
 
@@ -170,17 +190,18 @@ def remove(pattern_id: str):
 @define(kw_only=True)
 class LockInfo:
     snapshot_tag: str | None = None
-    tracked_files: list[dict[str, str]] = field(factory=list)
+    files: list[str] = field(factory=list)
+    hashes: list[str] = field(factory=list)
 
 
 @define(kw_only=True)
 class BlobmanConfig:
-    git_root: Path = _git_root()
+    git_root: Path = GIT_ROOT
     repository_url: str
     repository_password: str
     include_patterns: dict[str, str] = field(factory=dict)
-    lock: LockInfo = field(factory=LockInfo)
-    worktree_lock: LockInfo = field(factory=LockInfo)
+    lock: LockInfo | None = field(factory=LockInfo)
+    worktree_lock: LockInfo | None = field(factory=LockInfo)
 
 
 @define(kw_only=True)
@@ -191,74 +212,236 @@ class LockDiff:
     unchanged_files: list[dict[str, str]] = field(factory=list)
 
 
-def _load_config() -> BlobmanConfig:
-    for p in (CONFIG_PATH, LOCK_PATH,):
-        if not p.exists():
-            print(f'Error: file not found {p}')
-            exit(1)
-    config_json = json.loads(CONFIG_PATH.read_text())
-    lock = json.loads(LOCK_PATH.read_text())
-    worktree_lock = {
-        'tracked_files': [
-            {
-                'file': f,
-                'hash': run(f'shasum {f} | awk "{{ print $1 }}"', hide=True).stdout.strip()
-            } for f in _ls(config_json['include_patterns'])
-        ]
-    }
-    lock_map = {f['file']: f['hash'] for f in lock['tracked_files']}
-    worktree_map = {f['file']: f['hash'] for f in worktree_lock['tracked_files']}
-    if lock_map == worktree_map:
-        worktree_lock['snapshot_tag'] = lock['snapshot_tag']
-    else:
-        worktree_lock['snapshot_tag'] = None
-    return cattrs.structure(
-        config_json | {
-            'git_root': _git_root(),
+# generate (un)structuring code once at import instead of lazily on first use
+converter = cattrs.Converter()
+converter.register_unstructure_hook(LockInfo, make_dict_unstructure_fn(LockInfo, converter))
+converter.register_unstructure_hook(BlobmanConfig, make_dict_unstructure_fn(BlobmanConfig, converter))
+_structure_lock = make_dict_structure_fn(LockInfo, converter)
+converter.register_structure_hook(LockInfo, lambda o, t: _structure_lock(_upgrade_lock(o), t))
+converter.register_structure_hook(BlobmanConfig, make_dict_structure_fn(BlobmanConfig, converter))
+
+
+# config.json only, lock files are not parsed
+def _load_config_light() -> BlobmanConfig:
+    if not CONFIG_PATH.exists():
+        print(f'Error: file not found {CONFIG_PATH}')
+        exit(1)
+    return converter.structure(
+        orjson.loads(CONFIG_PATH.read_bytes()) | {
+            'git_root': GIT_ROOT,
             'repository_password': PASSWORD_PATH.read_text(),
-            'lock': lock,
-            'worktree_lock': worktree_lock,
+            'lock': None,
+            'worktree_lock': None,
         },
         BlobmanConfig
     )
 
 
+# snapshot tag only, _store_config writes it as first key so only head of lock
+# file is read, others (hand edited, legacy) fall back to parsing whole file
+_SNAPSHOT_TAG_HEAD_RE = re.compile(rb'\{\s*"snapshot_tag"\s*:\s*(?:null|"([^"\\]*)")\s*[,}]')
+
+
+def _locked_snapshot_tag() -> str | None:
+    if not LOCK_PATH.exists():
+        return None
+    with open(LOCK_PATH, 'rb') as f:
+        if m := _SNAPSHOT_TAG_HEAD_RE.match(f.read(256)):
+            return m[1] and m[1].decode()
+    return orjson.loads(LOCK_PATH.read_bytes()).get('snapshot_tag')
+
+
+def _load_config_full(need_hashes=True) -> BlobmanConfig:
+    c = _load_config_light()
+    if not LOCK_PATH.exists():
+        print(f'Error: file not found {LOCK_PATH}')
+        exit(1)
+    lock = _upgrade_lock(orjson.loads(LOCK_PATH.read_bytes()))
+    worktree_lock = {}
+    if need_hashes:
+        stats = _ls_stat(c.include_patterns)
+        files = sorted(stats)
+        hash_map = _hash_files(stats)
+        worktree_lock['files'] = files
+        worktree_lock['hashes'] = [hash_map[f] for f in files]
+        # both are sorted by file, so plain list comparison decides equality
+        if lock['files'] == files and lock['hashes'] == worktree_lock['hashes']:
+            worktree_lock['snapshot_tag'] = lock['snapshot_tag']
+    c.lock = converter.structure(lock, LockInfo)
+    c.worktree_lock = converter.structure(worktree_lock, LockInfo)
+    return c
+
+
 def _store_config(config: BlobmanConfig) -> None:
-    o = cattrs.unstructure(config)
+    o = converter.unstructure(config)
     o.pop('git_root')
     PASSWORD_PATH.write_text(o.pop('repository_password'))
-    LOCK_PATH.write_text(json.dumps(o.pop('lock'), indent=4))
+    if (lock := o.pop('lock')) is not None:  # not loaded by _load_config_light
+        LOCK_PATH.write_bytes(orjson.dumps(lock, option=orjson.OPT_INDENT_2))
     o.pop('worktree_lock')
-    CONFIG_PATH.write_text(json.dumps(o, indent=4))
+    CONFIG_PATH.write_bytes(orjson.dumps(o, option=orjson.OPT_INDENT_2))
+
+
+# lock files used to store list of {file, hash} objects instead of parallel lists
+def _upgrade_lock(o: dict) -> dict:
+    if 'tracked_files' not in o:
+        return o
+    return {
+        'snapshot_tag': o.get('snapshot_tag'),
+        'files': [f['file'] for f in o['tracked_files']],
+        'hashes': [f['hash'] for f in o['tracked_files']],
+    }
 
 
 def _get_env(c: BlobmanConfig):
     return {
-        'PWD': _git_root(),
+        'PWD': GIT_ROOT,
         'RESTIC_REPOSITORY': c.repository_url,
         'RESTIC_PASSWORD': c.repository_password,
     }
 
 
+def _hash_file(path) -> str:
+    h = hashlib.sha1()
+    with open(path, 'rb', buffering=1 << 20) as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+# hash whole batch at once, hashlib releases GIL so threads scale with cores
+# files with same mtime & size as in local hash cache are not rehashed,
+# stats come from the tracked files walk so nothing is stat'ed twice
+def _hash_files(stats: dict[str, os.stat_result]) -> dict[str, str]:
+    cache = msgpack.unpackb(HASH_CACHE_PATH.read_bytes()) if HASH_CACHE_PATH.exists() else {}
+    key = lambda st: {'mtime_ns': st.st_mtime_ns, 'size': st.st_size}
+    stale = [f for f in stats if f not in cache or cache[f] | key(stats[f]) != cache[f]]
+    if stale:
+        with ThreadPoolExecutor(max_workers=min(len(stale), os.cpu_count() or 1)) as ex:
+            for f, h in zip(stale, ex.map(_hash_file, stale)):
+                cache[f] = key(stats[f]) | {'sha1': h}
+    if stale or cache.keys() != stats.keys():
+        cache = {f: cache[f] for f in stats}  # drop no longer tracked files
+        if not HASH_CACHE_PATH.exists():
+            # ignored next to cache itself, leaving user's .gitignore untouched
+            HASH_CACHE_GITIGNORE_PATH.write_text(HASH_CACHE_PATH.name + '\n')
+        HASH_CACHE_PATH.write_bytes(msgpack.packb(cache))
+    return {f: cache[f]['sha1'] for f in stats}
+
+
 def _ls(patterns: dict[str, str], root_dir=None):
-    fn = lambda p: glob.glob(p, recursive=True, include_hidden=False)
-    paths = set(itertools.chain(*map(fn, patterns.values())))
-    for p in set(paths):
-        if Path(p).is_dir():
-            paths |= set(glob.glob(str(Path(p) / '**'), recursive=True, include_hidden=False))
-    for p in set(paths):
-        if not Path(p).is_file():
-            paths.discard(p)  # discard non-regular-files
-    for p in sorted(paths):
+    for p in sorted(_ls_stat(patterns)):
         yield p
 
 
+# tracked regular files mapped to their stat results
+def _ls_stat(patterns: dict[str, str]) -> dict[str, os.stat_result]:
+    stats = {}
+    if patterns:  # walk patterns concurrently, overlapping I/O latency of each walk
+        with ThreadPoolExecutor(max_workers=min(32, len(patterns))) as ex:
+            for found in ex.map(lambda p: dict(_glob(p)), patterns.values()):
+                stats.update(found)
+    return stats
+
+
+# like glob.glob(recursive=True, include_hidden=False), but matched directories
+# expand to all regular files inside them and each tree is scanned only once
+def _glob(pattern: str):
+    if not glob.has_magic(pattern):
+        if st := _stat_file(pattern):
+            yield pattern, st
+        elif os.path.isdir(pattern):
+            yield from _walk(pattern, [], [], {0})
+        return
+    # only walk subtree under literal prefix, e.g. 'data/blobs' for 'data/blobs/**/*.bin'
+    parts = pattern.split('/')
+    i = next(i for i, s in enumerate(parts) if glob.has_magic(s))
+    root = '/'.join(parts[:i]) or ('/' if pattern.startswith('/') else '')
+    if root and not os.path.isdir(root):
+        return
+    segs = [s for s in parts[i:] if s not in ('', '.')]
+    if pattern.endswith('/'):
+        segs.append('')  # directories only, passed by entering a directory
+    regexes = [_pattern_re(s) if s not in ('**', '') else None for s in segs]
+    yield from _walk(root, segs, regexes, _skip_recursive(segs, {0}, in_dir=bool(root)))
+
+
+# compiled once per process, _ls may run several times during single command
+@lru_cache(maxsize=256)
+def _pattern_re(pattern: str) -> re.Pattern:
+    return re.compile(fnmatch.translate(pattern))
+
+
+# states are indices of pattern segments still to be matched, len(segs) means matched
+# os.fwalk keeps directory fds open, so files are stat'ed relative to them
+# symlinked directories are followed like glob does, except those looping back
+def _walk(root: str, segs: list[str], regexes: list, states: set[int]):
+    pending = {root or '.': (root, states, frozenset())}
+    for dirpath, dirnames, filenames, dirfd in os.fwalk(root or '.', follow_symlinks=True):
+        path, states, ancestors = pending.pop(dirpath)
+        st = os.fstat(dirfd)
+        ancestors |= {(st.st_dev, st.st_ino)}
+        kept = []
+        for d in dirnames:
+            next_states = _skip_recursive(segs, _match_name(segs, regexes, states, d))
+            if next_states and _dir_id(d, dirfd) not in ancestors:
+                pending[os.path.join(dirpath, d)] = (os.path.join(path, d), next_states, ancestors)
+                kept.append(d)
+        dirnames[:] = kept  # prune subtrees which can't match
+        for f in filenames:
+            if len(segs) in _match_name(segs, regexes, states, f) and (st := _stat_file(f, dirfd)):
+                yield os.path.join(path, f), st
+
+
+def _dir_id(name: str, dir_fd: int) -> tuple[int, int] | None:
+    try:
+        st = os.stat(name, dir_fd=dir_fd)
+    except OSError:
+        return None
+    return st.st_dev, st.st_ino
+
+
+def _stat_file(name: str, dir_fd: int | None = None) -> os.stat_result | None:
+    try:
+        st = os.stat(name, dir_fd=dir_fd)
+    except OSError:
+        return None
+    return st if stat.S_ISREG(st.st_mode) else None
+
+
+def _match_name(segs: list[str], regexes: list, states: set[int], name: str) -> set[int]:
+    hidden = name.startswith('.')
+    next_states = set()
+    for i in states:
+        if i == len(segs) or segs[i] == '**':
+            if not hidden:
+                next_states.add(i)
+        elif segs[i] and regexes[i].match(name) and (not hidden or segs[i].startswith('.')):
+            next_states.add(i + 1)
+    return next_states
+
+
+# '**' may also match zero directories, files must match last segment itself
+# trailing '' is only passed inside a directory, so 'x/' never matches file 'x'
+def _skip_recursive(segs: list[str], states: set[int], in_dir: bool = True) -> set[int]:
+    skipped = set(states)
+    for i in states:
+        while i < len(segs) and (segs[i] == '**' or (in_dir and segs[i] == '')):
+            i += 1
+            skipped.add(i)
+    return skipped
+
+
+# staged & committed files (whole index), invariant during single CLI run
+@lru_cache(maxsize=None)
+def _git_files() -> frozenset[str]:
+    return frozenset(run('git ls-files --cached -z', hide=True).stdout.split('\0'))
+
+
 # ensure no collisions between tracked files and git files
 def _ensure_no_collisions(c: BlobmanConfig):
     blob_matching = set(_ls(c.include_patterns))
-    git_staged = set(run("git diff --name-only --cached", hide=True).stdout.split('\n'))
-    git_tracked = set(run('git ls-tree -r HEAD --name-only', hide=True).stdout.split('\n'))
-    common = blob_matching.intersection(git_staged) | blob_matching.intersection(git_tracked)
+    common = blob_matching.intersection(_git_files())
     if common:
         print('Error: collision between git tracked files and blobs\n')
         print('\nFollowing files are tracked both by .git and blobman:\n')
@@ -268,29 +451,33 @@ def _ensure_no_collisions(c: BlobmanConfig):
         exit(1)
 
 
-def _ensure_line(line, file):
-    if line in map(str.strip, Path(file).read_text().split('\n')):
+def _ensure_lines(lines: Iterable[str], file):
+    text = Path(file).read_text() if Path(file).exists() else ''
+    present = set(map(str.strip, text.split('\n')))
+    missing = [str(line) for line in lines if str(line) not in present]
+    if not missing:
         return
     with Path(file).open('a') as f:
-        f.write(str(line) + '\n')
+        f.write(('\n' if text and not text.endswith('\n') else '') + '\n'.join(missing) + '\n')
 
 
 def _diff_locks(src: LockInfo, dst: LockInfo) -> LockDiff:
-    if src.snapshot_tag == dst.snapshot_tag and None not in (src.snapshot_tag, dst.snapshot_tag):
+    same_snapshot = src.snapshot_tag == dst.snapshot_tag and src.snapshot_tag is not None
+    if same_snapshot or (src.files == dst.files and src.hashes == dst.hashes):
         return LockDiff(
-            unchanged_files=set(p['file'] for p in src.tracked_files)
+            unchanged_files=set(src.files)
         )
-    src_files = set(p['file'] for p in src.tracked_files)
-    dst_files = set(p['file'] for p in dst.tracked_files)
-    common_files = src_files.intersection(dst_files)
-    src_map = {f['file']: f['hash'] for f in src.tracked_files}
-    dst_map = {f['file']: f['hash'] for f in dst.tracked_files}
-    changed_files = set(p for p in common_files if src_map[p] != dst_map[p])
+    src_map = dict(zip(src.files, src.hashes))
+    dst_map = dict(zip(dst.files, dst.hashes))
+    # (file, hash) pairs are compared by set algebra on item views, so python
+    # level loop only runs over pairs which differ between locks
+    differing_files = {p for p, _ in src_map.items() - dst_map.items()}
+    removed_files = src_map.keys() - dst_map.keys()
     return LockDiff(
-        added_files=dst_files - src_files,
-        removed_files=src_files - dst_files,
-        modified_files=changed_files,
-        unchanged_files=common_files - changed_files,
+        added_files=dst_map.keys() - src_map.keys(),
+        removed_files=removed_files,
+        modified_files=differing_files - removed_files,
+        unchanged_files=src_map.keys() - differing_files,
     )
 
 
@@ -0,0 +1,60 @@
+import hashlib
+import os
+
+import msgpack
+import pytest
+
+import blobman
+from blobman import _hash_files
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(blobman, 'HASH_CACHE_PATH', tmp_path / 'hash-cache.msgpack')
+    monkeypatch.setattr(blobman, 'HASH_CACHE_GITIGNORE_PATH', tmp_path / '.gitignore')
+    hashed = []
+    hash_file = blobman._hash_file
+    monkeypatch.setattr(blobman, '_hash_file', lambda p: hashed.append(p) or hash_file(p))
+    for f in ('a.bin', 'b.bin'):
+        (tmp_path / f).write_bytes(f.encode())
+    return hashed
+
+
+def _stats(*files):
+    return {f: os.stat(f) for f in files}
+
+
+def test_hashes_match_content(cache):
+    assert _hash_files(_stats('a.bin')) == {'a.bin': hashlib.sha1(b'a.bin').hexdigest()}
+
+
+def test_unchanged_files_are_not_rehashed(cache):
+    first = _hash_files(_stats('a.bin', 'b.bin'))
+    cache.clear()
+    assert _hash_files(_stats('a.bin', 'b.bin')) == first
+    assert cache == []
+
+
+# same size with newer mtime, or other size with mtime kept as before
+@pytest.mark.parametrize('content, mtime_delta', [(b'A.BIN', 1), (b'longer content', 0)])
+def test_changed_mtime_or_size_rehashes(cache, content, mtime_delta):
+    _hash_files(_stats('a.bin', 'b.bin'))
+    cache.clear()
+    st = os.stat('a.bin')
+    with open('a.bin', 'wb') as f:
+        f.write(content)
+    os.utime('a.bin', ns=(st.st_atime_ns, st.st_mtime_ns + mtime_delta))
+    assert _hash_files(_stats('a.bin', 'b.bin'))['a.bin'] == hashlib.sha1(content).hexdigest()
+    assert cache == ['a.bin']
+
+
+def test_untracked_files_are_pruned(cache):
+    _hash_files(_stats('a.bin', 'b.bin'))
+    _hash_files(_stats('a.bin'))
+    assert msgpack.unpackb(blobman.HASH_CACHE_PATH.read_bytes()).keys() == {'a.bin'}
+
+
+def test_cache_is_gitignored_on_creation(cache):
+    _hash_files(_stats('a.bin'))
+    assert blobman.HASH_CACHE_GITIGNORE_PATH.read_text() == 'hash-cache.msgpack\n'
@@ -0,0 +1,83 @@
+import random
+
+import attrs
+import orjson
+import pytest
+
+import blobman
+from blobman import BlobmanConfig, LockDiff, LockInfo, _diff_locks, _locked_snapshot_tag, converter
+
+
+# reference semantics: per file comparison of hashes present in both locks
+def _reference_diff(src: LockInfo, dst: LockInfo) -> LockDiff:
+    src_map, dst_map = dict(zip(src.files, src.hashes)), dict(zip(dst.files, dst.hashes))
+    common = src_map.keys() & dst_map.keys()
+    modified = {f for f in common if src_map[f] != dst_map[f]}
+    return LockDiff(
+        added_files=dst_map.keys() - src_map.keys(),
+        removed_files=src_map.keys() - dst_map.keys(),
+        modified_files=modified,
+        unchanged_files=common - modified,
+    )
+
+
+# fields left at their list defaults compare equal to empty sets
+def _sets(diff: LockDiff) -> dict[str, set[str]]:
+    return {k: set(v) for k, v in attrs.asdict(diff).items()}
+
+
+def _random_lock(rng: random.Random, files: list[str]) -> LockInfo:
+    picked = sorted(rng.sample(files, rng.randint(0, len(files))))
+    return LockInfo(files=picked, hashes=[rng.choice('012') for _ in picked])
+
+
+def test_legacy_tracked_files_lock_is_upgraded():
+    legacy = {
+        'snapshot_tag': 'abcd1234',
+        'tracked_files': [{'file': 'a.bin', 'hash': '01'}, {'file': 'b.bin', 'hash': '02'}],
+    }
+    assert converter.structure(legacy, LockInfo) == LockInfo(
+        snapshot_tag='abcd1234', files=['a.bin', 'b.bin'], hashes=['01', '02'],
+    )
+
+
+def test_legacy_lock_is_upgraded_inside_config():
+    c = converter.structure({
+        'repository_url': 'url',
+        'repository_password': 'secret',
+        'lock': {'snapshot_tag': None, 'tracked_files': [{'file': 'a.bin', 'hash': '01'}]},
+    }, BlobmanConfig)
+    assert c.lock == LockInfo(files=['a.bin'], hashes=['01'])
+
+
+def test_lock_roundtrip():
+    lock = LockInfo(snapshot_tag='abcd1234', files=['a.bin'], hashes=['01'])
+    assert converter.unstructure(lock) == {'snapshot_tag': 'abcd1234', 'files': ['a.bin'], 'hashes': ['01']}
+    assert converter.structure(converter.unstructure(lock), LockInfo) == lock
+
+
+@pytest.mark.parametrize('seed', range(50))
+def test_diff_locks_matches_reference(seed):
+    rng = random.Random(seed)
+    files = [f'f{i}.bin' for i in range(rng.randint(0, 20))]
+    src, dst = _random_lock(rng, files), _random_lock(rng, files)
+    assert _sets(_diff_locks(src, dst)) == _sets(_reference_diff(src, dst))
+    assert _sets(_diff_locks(src, src)) == _sets(_reference_diff(src, src))
+
+
+def test_diff_locks_same_snapshot_is_unchanged():
+    src = LockInfo(snapshot_tag='abcd1234', files=['a.bin'], hashes=['01'])
+    dst = LockInfo(snapshot_tag='abcd1234', files=['a.bin'], hashes=['02'])
+    assert _diff_locks(src, dst) == LockDiff(unchanged_files={'a.bin'})
+
+
+@pytest.mark.parametrize('lock', [
+    {'snapshot_tag': 'abcd1234', 'files': ['a.bin'] * 1000, 'hashes': ['01'] * 1000},
+    {'snapshot_tag': None, 'files': [], 'hashes': []},
+    {'files': ['a.bin'], 'hashes': ['01'], 'snapshot_tag': 'abcd1234'},  # not written first
+    {'tracked_files': [], 'snapshot_tag': 'abcd1234'},
+])
+def test_locked_snapshot_tag(tmp_path, monkeypatch, lock):
+    monkeypatch.setattr(blobman, 'LOCK_PATH', tmp_path / 'lock.json')
+    blobman.LOCK_PATH.write_bytes(orjson.dumps(lock, option=orjson.OPT_INDENT_2))
+    assert _locked_snapshot_tag() == lock['snapshot_tag']
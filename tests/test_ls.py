@@ -0,0 +1,97 @@
+import glob
+import itertools
+import os
+from pathlib import Path
+
+import pytest
+
+from blobman import _ls
+
+
+# reference semantics: glob every pattern, expand matched directories, keep regular files
+def _glob_ls(patterns: dict[str, str]):
+    fn = lambda p: glob.glob(p, recursive=True, include_hidden=False)
+    paths = set(itertools.chain(*map(fn, patterns.values())))
+    for p in set(paths):
+        if Path(p).is_dir():
+            paths |= set(glob.glob(str(Path(p) / '**'), recursive=True, include_hidden=False))
+    return sorted(p for p in paths if Path(p).is_file())
+
+
+@pytest.fixture
+def tree(tmp_path, monkeypatch):
+    for f in (
+        'top.bin',
+        'data/readme.txt',
+        'data/a.bin',
+        'data/.dot.bin',
+        'data/sub/x.bin',
+        'data/sub/deep/y.txt',
+        'data/sub2/z.bin',
+        'data/.hidden/h.bin',
+        'other/o.bin',
+        'other/inner/p.bin',
+        '.secret/s.bin',
+    ):
+        (tmp_path / f).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / f).write_text(f)
+    (tmp_path / 'data/link').symlink_to('../other')
+    (tmp_path / 'data/filelink.bin').symlink_to('a.bin')
+    (tmp_path / 'data/empty').mkdir()
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.mark.parametrize('pattern', [
+    '**',
+    '**/*.bin',
+    '**/',
+    '*/',
+    '*.bin',
+    'data',
+    'data/',
+    'data/*',
+    'data/*/',
+    'data/*/**',
+    'data/**',
+    'data/**/',
+    'data/**/*.bin',
+    'data/*/*.bin',
+    'data/**/deep/**',
+    'data/.hidden',
+    'data/.*',
+    'data/sub/x.bin',
+    'data/link/**',
+    'data/l*/*.bin',
+    'd?ta/s*',
+    '[do]*/*.bin',
+    '.secret',
+    './data/*.bin',
+    'missing/**',
+])
+def test_ls_matches_glob(tree, pattern):
+    assert list(_ls({'id': pattern})) == _glob_ls({'id': pattern})
+
+
+def test_ls_multiple_patterns(tree):
+    patterns = {'a': 'data/*.bin', 'b': 'other/**', 'c': 'data/sub'}
+    assert list(_ls(patterns)) == _glob_ls(patterns)
+
+
+def test_ls_trailing_slash_matches_directories_only(tree):
+    assert 'data/readme.txt' not in _ls({'id': 'data/*/'})
+    assert 'data/readme.txt' not in _ls({'id': 'data/*/**'})
+    assert 'top.bin' not in _ls({'id': '**/'})
+
+
+def test_ls_stops_at_symlink_loops(tree):
+    os.symlink('..', tree / 'data/sub/loop')
+    files = list(_ls({'id': 'data/**'}))
+    assert 'data/sub/x.bin' in files
+    assert not any('loop' in f for f in files)
+
+
+@pytest.mark.parametrize('pattern', ['data/link', 'data/link/', 'data/link/inner/*.bin'])
+def test_ls_follows_symlinked_walk_root(tree, pattern):
+    files = list(_ls({'id': pattern}))
+    assert files and files == _glob_ls({'id': pattern})